@@ -1,87 +1,180 @@
 """Smart Document Finder - Simple, clean search interface."""
 
 import streamlit as st
-from model import extract_text, chunk_text, build_index, search, CONFIG, estimate_page
+from model import (extract_text, chunk_text, build_index, search, CONFIG, estimate_page,
+                   load_index, save_index, ENCODER_BACKEND, INDEX_FORMAT_VERSION, PDF_BACKEND)
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from itertools import chain
+import hashlib
+import io
 import logging
 import re
 
+try:
+    import ahocorasick  # pyahocorasick
+except ImportError:
+    ahocorasick = None
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+MARK_OPEN = '<mark style="background-color: #ffff00; font-weight: bold;">'
+MARK_CLOSE = '</mark>'
+
+
+@lru_cache(maxsize=128)
+def _query_pattern(query: str) -> "re.Pattern":
+    """One case-insensitive alternation of the query words, longest first."""
+    words = sorted({word for word in query.split() if word.strip()}, key=lambda w: (-len(w), w))
+    return re.compile("(" + "|".join(re.escape(word) for word in words) + ")", re.IGNORECASE)
+
+
+@lru_cache(maxsize=128)
+def _query_automaton(query: str):
+    """Aho-Corasick automaton over the lowercased query words."""
+    automaton = ahocorasick.Automaton()
+    for word in query.split():
+        if word.strip():
+            automaton.add_word(word.lower(), len(word.lower()))
+    automaton.make_automaton()
+    return automaton
+
+
 def highlight_query(text: str, query: str) -> str:
     """Highlight query words in text with yellow background."""
     try:
-        # Split query into words and highlight each one
-        words = query.split()
-        highlighted = text
+        if not query.strip():
+            return text
+        
+        text_lower = text.lower()
+        # Offsets into text_lower must map 1:1 onto text
+        if ahocorasick is None or len(text_lower) != len(text):
+            return _query_pattern(query).sub(rf'{MARK_OPEN}\1{MARK_CLOSE}', text)
         
-        for word in words:
-            if word.strip():
-                # Case-insensitive highlighting
-                pattern = re.compile(f'({re.escape(word)})', re.IGNORECASE)
-                highlighted = pattern.sub(
-                    r'<mark style="background-color: #ffff00; font-weight: bold;">\1</mark>',
-                    highlighted
-                )
-        return highlighted
+        # Find every case-insensitive occurrence of every word in one scan
+        automaton = _query_automaton(query)
+        
+        # Earliest start first, longest match wins, no overlaps
+        matches = sorted((end - length + 1, -length) for end, length in automaton.iter(text_lower))
+        parts = []
+        last = 0
+        for start, neg_length in matches:
+            if start < last:
+                continue
+            end = start - neg_length
+            parts.extend([text[last:start], MARK_OPEN, text[start:end], MARK_CLOSE])
+            last = end
+        parts.append(text[last:])
+        return "".join(parts)
     except:
         return text
 
 
+def _text_result_block(i: int, text: str, score: float) -> tuple:
+    return (
+        f"RESULT {i}",
+        f"Confidence: {int(score * 100)}%",
+        f"Score: {score:.4f}",
+        "-" * 80,
+        text,
+        "-" * 80,
+        ""
+    )
+
+
+def _markdown_result_block(i: int, text: str, score: float) -> tuple:
+    return (
+        f"## Result {i}",
+        f"- **Confidence:** {int(score * 100)}%",
+        f"- **Score:** {score:.4f}",
+        "",
+        "```",
+        text,
+        "```",
+        ""
+    )
+
+
 def format_export_text(results: list, query: str, file_names: list) -> str:
     """Format results as plain text for export."""
-    lines = [
+    ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    header = (
         "=" * 80,
         "SMART DOCUMENT FINDER - SEARCH RESULTS",
         "=" * 80,
         f"Query: {query}",
         f"Results: {len(results)}",
         f"Files: {', '.join(file_names)}",
-        f"Generated: {__import__('datetime').datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+        f"Generated: {ts}",
         "=" * 80,
         ""
-    ]
-    
-    for i, (text, score) in enumerate(results, 1):
-        confidence = int(score * 100)
-        lines.extend([
-            f"RESULT {i}",
-            f"Confidence: {confidence}%",
-            f"Score: {score:.4f}",
-            "-" * 80,
-            text,
-            "-" * 80,
-            ""
-        ])
-    
-    return "\n".join(lines)
+    )
+    blocks = (_text_result_block(i, text, score) for i, (text, score, _) in enumerate(results, 1))
+    return "\n".join(chain(header, chain.from_iterable(blocks)))
 
 
 def format_export_markdown(results: list, query: str, file_names: list) -> str:
     """Format results as Markdown for export."""
-    lines = [
+    ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    header = (
         "# Search Results",
         f"**Query:** `{query}`",
         f"**Results:** {len(results)}",
         f"**Files:** {', '.join(file_names)}",
-        f"**Generated:** {__import__('datetime').datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+        f"**Generated:** {ts}",
         "",
-    ]
+    )
+    blocks = (_markdown_result_block(i, text, score) for i, (text, score, _) in enumerate(results, 1))
+    return "\n".join(chain(header, chain.from_iterable(blocks)))
+
+
+# Underscore-prefixed arguments are skipped by Streamlit's hasher; the
+# content hash passed alongside them is the cache key.
+@st.cache_data(max_entries=CONFIG["INDEX_CACHE_SIZE"], show_spinner=False)
+def extract_documents(files_hash: str, _files: list) -> dict:
+    """Extract and concatenate text from (name, bytes) pairs."""
+    all_text = ""
+    file_names = []
+    
+    def extract(f):
+        return f[0], extract_text(io.BytesIO(f[1]), f[0])
     
-    for i, (text, score) in enumerate(results, 1):
-        confidence = int(score * 100)
-        lines.extend([
-            f"## Result {i}",
-            f"- **Confidence:** {confidence}%",
-            f"- **Score:** {score:.4f}",
-            "",
-            f"```",
-            text,
-            f"```",
-            ""
-        ])
+    if PDF_BACKEND == "pymupdf":
+        # PyMuPDF does not support multithreaded use (and holds the GIL anyway)
+        texts = [extract(f) for f in _files]
+    else:
+        # DOCX unzipping/lxml parsing release the GIL; pdfplumber is pure Python and
+        # gains little, but is thread-safe. map keeps upload order.
+        with ThreadPoolExecutor(max_workers=max(1, min(8, len(_files)))) as pool:
+            texts = list(pool.map(extract, _files))
     
-    return "\n".join(lines)
+    for name, text in texts:
+        if text:
+            all_text += text + "\n"
+            file_names.append(name)
+    
+    return {
+        "text": all_text,
+        "files": file_names,
+        "char_count": len(all_text)
+    }
+
+
+@st.cache_resource(ttl=24*60*60, max_entries=CONFIG["INDEX_CACHE_SIZE"], show_spinner=False)
+def build_index_cached(files_hash: str, chunk_size: int, overlap: int, _full_text: str) -> dict:
+    """Chunk and index a document set; shared across sessions and reruns."""
+    # Persisted on disk too, so a process restart only has to mmap the index
+    key = hashlib.sha1(
+        f"{files_hash}:{CONFIG['MODEL']}:{ENCODER_BACKEND}:v{INDEX_FORMAT_VERSION}:{chunk_size}:{overlap}".encode()
+    ).hexdigest()
+    index = load_index(key)
+    if index is None:
+        index = build_index(chunk_text(_full_text, chunk_size, overlap), _full_text)
+        save_index(index, key)
+    return index
+
 
 # Page config
 st.set_page_config(page_title="Smart Document Finder", page_icon="📚", layout="wide")
@@ -103,32 +196,29 @@ if "extracted_text" not in st.session_state:
     st.session_state.extracted_text = None
 if "last_files" not in st.session_state:
     st.session_state.last_files = None
+if "files_hash" not in st.session_state:
+    st.session_state.files_hash = None
 if "index" not in st.session_state:
     st.session_state.index = None
-if "chunks" not in st.session_state:
-    st.session_state.chunks = None
 
 # Extract text when files change
 if uploaded_files and uploaded_files != st.session_state.last_files:
     st.session_state.last_files = uploaded_files
     
-    all_text = ""
-    file_names = []
+    files = [(file.name, file.getvalue()) for file in uploaded_files]
+    # Length-prefix each field so different uploads can't concatenate to the same input
+    hasher = hashlib.sha1()
+    for name, data in files:
+        for field in (name.encode("utf-8"), data):
+            hasher.update(len(field).to_bytes(8, "little"))
+            hasher.update(field)
+    st.session_state.files_hash = hasher.hexdigest()
     
     with st.spinner("Extracting text..."):
-        for file in uploaded_files:
-            text = extract_text(file, file.name)
-            if text:
-                all_text += text + "\n"
-                file_names.append(file.name)
-        
-        st.session_state.extracted_text = {
-            "text": all_text,
-            "files": file_names,
-            "char_count": len(all_text)
-        }
+        st.session_state.extracted_text = extract_documents(st.session_state.files_hash, files)
     
-    st.success(f"✅ Extracted {len(all_text):,} chars from {len(file_names)} file(s)")
+    extracted = st.session_state.extracted_text
+    st.success(f"✅ Extracted {extracted['char_count']:,} chars from {len(extracted['files'])} file(s)")
 
 # ============================================================================
 # SEARCH
@@ -147,22 +237,20 @@ if st.session_state.extracted_text:
     with col3:
         k = st.slider("Results", 1, 10, CONFIG["K"])
     
-    # Check if config changed or first time
-    config_key = (chunk_size, overlap)
-    if "config_key" not in st.session_state:
-        st.session_state.config_key = config_key
+    # Rebuild (or fetch the shared cached) index when files or config change
+    index_key = (st.session_state.files_hash, chunk_size, overlap)
+    if "index_key" not in st.session_state:
+        st.session_state.index_key = index_key
     
-    # Build index ONLY if config changed or index doesn't exist
-    if st.session_state.config_key != config_key or st.session_state.index is None:
-        st.session_state.config_key = config_key
+    if st.session_state.index_key != index_key or st.session_state.index is None:
+        st.session_state.index_key = index_key
         
         with st.spinner("Building search index..."):
-            st.session_state.chunks = chunk_text(full_text, chunk_size, overlap)
-            st.session_state.index = build_index(st.session_state.chunks)
-            st.success(f"✅ Index ready ({len(st.session_state.chunks)} chunks, built in {st.session_state.index['time']:.2f}s)")
+            st.session_state.index = build_index_cached(*index_key, full_text)
+            index = st.session_state.index
+            action = "loaded from disk" if index["from_disk"] else "built"
+            st.success(f"✅ Index ready ({len(index['chunks'])} chunks, {action} in {index['time']:.2f}s)")
     
-    # Use cached index and chunks
-    chunks = st.session_state.chunks
     index = st.session_state.index
     
     # Search
@@ -175,9 +263,9 @@ if st.session_state.extracted_text:
         if results:
             st.subheader(f"📋 Results ({len(results)})")
             
-            for i, (text, score) in enumerate(results, 1):
+            for i, (text, score, offset) in enumerate(results, 1):
                 confidence = int(score * 100)
-                page = estimate_page(text, full_text)
+                page = estimate_page(offset, index)
                 
                 # Color-coded badge - adjusted for better model
                 if confidence >= 80:
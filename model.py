@@ -4,18 +4,37 @@ Uses advanced models and hybrid search for 90%+ accuracy.
 """
 
 from sentence_transformers import SentenceTransformer
-from rank_bm25 import BM25Okapi
+import torch
+import bm25s
+import simsimd  # SIMD int8 dot-product kernels (AVX-512 VNNI / NEON)
 import pdfplumber
 import docx
 import re
 import numpy as np
 import logging
-from typing import Dict, List, Tuple, Any
+import os
+import pickle
+from typing import Dict, List, Optional, Tuple, Any
 import time
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    import fitz  # PyMuPDF: faster PDF extraction, AGPL-3.0 licensed (opt-in, not in requirements)
+except ImportError:
+    fitz = None
+
+# PyMuPDF is not thread-safe, so callers must not extract PDFs concurrently with it
+PDF_BACKEND = "pymupdf" if fitz is not None else "pdfplumber"
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
 CONFIG = {
     "MODEL": "BAAI/bge-small-en-v1.5",  # Best for semantic search
     "CHUNK_SIZE": 500,  # Smaller chunks = better accuracy
@@ -23,15 +42,175 @@ CONFIG = {
     "K": 5,
     "SEMANTIC_WEIGHT": 0.7,  # 70% semantic, 30% BM25
     "BM25_WEIGHT": 0.3,
+    "ONNX_DIR": "onnx_model",  # int8-quantized ONNX export of MODEL (CPU only)
+    "BATCH_SIZE": 128 if DEVICE == "cuda" else 64,
+    "INDEX_CACHE_DIR": "cache",  # On-disk index cache (None to disable)
+    "INDEX_CACHE_SIZE": 8,       # Max cached indexes, least recently used evicted
 }
 
-# Load model once
-try:
-    model = SentenceTransformer(CONFIG["MODEL"])
-    logger.info(f"✓ Loaded model: {CONFIG['MODEL']}")
-except Exception as e:
-    logger.error(f"Failed to load model: {e}")
-    raise
+# Same token rule bm25s.tokenize applies to the corpus (no stopword removal)
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+
+
+def load_onnx_encoder(model_name: str, onnx_dir: str) -> Tuple[Any, Any]:
+    """Export model to ONNX once, quantize to int8 and open an ORT session."""
+    import onnxruntime as ort
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+    
+    quantized_path = os.path.join(onnx_dir, "model_quantized.onnx")
+    if not os.path.exists(quantized_path):
+        logger.info(f"Exporting {model_name} to ONNX (int8)...")
+        ort_model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+        ort_model.save_pretrained(onnx_dir)
+        # Dynamic int8 quantization of the linear layers (VNNI on x86)
+        quantizer = ORTQuantizer.from_pretrained(ort_model)
+        qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        quantizer.quantize(save_dir=onnx_dir, quantization_config=qconfig)
+    
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    session = ort.InferenceSession(quantized_path, providers=["CPUExecutionProvider"])
+    return tokenizer, session
+
+
+# Load model once: quantized ONNX on CPU if available, else sentence-transformers
+model = None
+session = None
+if DEVICE == "cpu":
+    try:
+        tokenizer, session = load_onnx_encoder(CONFIG["MODEL"], CONFIG["ONNX_DIR"])
+        session_inputs = {i.name for i in session.get_inputs()}
+        logger.info(f"✓ Loaded model: {CONFIG['MODEL']} (ONNX int8)")
+    except Exception as e:
+        logger.warning(f"ONNX encoder unavailable, using sentence-transformers: {e}")
+
+if session is None:
+    try:
+        model = SentenceTransformer(CONFIG["MODEL"], device=DEVICE)
+        logger.info(f"✓ Loaded model: {CONFIG['MODEL']} ({DEVICE})")
+    except Exception as e:
+        logger.error(f"Failed to load model: {e}")
+        raise
+
+# Encoder that produces this process's embeddings; indexes must not mix backends
+ENCODER_BACKEND = "onnx-int8" if session is not None else "sentence-transformers"
+
+
+def encode(texts: List[str], batch_size: int = CONFIG["BATCH_SIZE"], show_progress_bar: bool = False,
+           normalize_embeddings: bool = False) -> np.ndarray:
+    """Embed texts as a float32 numpy array (N x dim)."""
+    if model is not None:
+        # Keep batches (and normalization) on-device; copy to host once at the end
+        embeddings = model.encode(texts, batch_size=batch_size, show_progress_bar=show_progress_bar,
+                                  normalize_embeddings=normalize_embeddings, convert_to_tensor=True)
+        return embeddings.cpu().numpy()
+    
+    batches = []
+    for i in range(0, len(texts), batch_size):
+        batch = tokenizer(texts[i:i + batch_size], padding="longest", truncation=True,
+                          max_length=512, return_tensors="np")
+        feeds = {name: batch[name].astype(np.int64) for name in session_inputs if name in batch}
+        hidden = session.run(None, feeds)[0]
+        # BGE pools on the [CLS] token, same as its sentence-transformers config
+        pooled = hidden[:, 0].astype(np.float32)
+        if normalize_embeddings:
+            # Normalize while the batch is cache-hot instead of a second N x dim pass
+            pooled /= np.linalg.norm(pooled, axis=1, keepdims=True) + 1e-10
+        batches.append(pooled)
+    
+    return np.concatenate(batches) if batches else np.empty((0, 0), dtype=np.float32)
+
+
+def aligned_empty(shape: Tuple[int, ...], dtype: Any, align: int = 64) -> np.ndarray:
+    """Uninitialized C-contiguous array whose data starts on an `align`-byte boundary."""
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    raw = np.empty(nbytes + align, dtype=np.uint8)
+    offset = (-raw.ctypes.data) % align
+    return raw[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-row int8 quantization. Returns (int8 rows, float32 scales)."""
+    scales = np.abs(vectors).max(axis=1, keepdims=True) / 127
+    scales[scales == 0] = 1.0
+    # 64-byte aligned so SIMD kernels use aligned loads (384-byte rows stay aligned too)
+    quantized = aligned_empty(vectors.shape, np.int8)
+    np.rint(vectors / scales, out=quantized, casting="unsafe")
+    return quantized, scales.ravel().astype(np.float32)
+
+
+def _fuse_and_topk_kernel(sem: np.ndarray, bm: np.ndarray, w_sem: float, w_bm: float,
+                          m: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Weighted semantic + max-normalized BM25 score, top-m selected with a min-heap."""
+    n = sem.shape[0]
+    bm_max = bm.max()
+    bm_scale = w_bm / bm_max if bm_max > 0 else w_bm
+    
+    combined = np.empty(n, dtype=np.float64)
+    for i in range(n):
+        combined[i] = w_sem * sem[i] + bm_scale * bm[i]
+    
+    # O(N log m) selection: heap root is the weakest of the best m so far
+    m = min(m, n)
+    heap_val = np.empty(m, dtype=np.float64)
+    heap_idx = np.empty(m, dtype=np.int64)
+    size = 0
+    for i in range(n):
+        v = combined[i]
+        if size < m:
+            j = size
+            size += 1
+            while j > 0:
+                parent = (j - 1) // 2
+                if heap_val[parent] <= v:
+                    break
+                heap_val[j] = heap_val[parent]
+                heap_idx[j] = heap_idx[parent]
+                j = parent
+            heap_val[j] = v
+            heap_idx[j] = i
+        elif v > heap_val[0]:
+            j = 0
+            while True:
+                child = 2 * j + 1
+                if child >= m:
+                    break
+                if child + 1 < m and heap_val[child + 1] < heap_val[child]:
+                    child += 1
+                if heap_val[child] >= v:
+                    break
+                heap_val[j] = heap_val[child]
+                heap_idx[j] = heap_idx[child]
+                j = child
+            heap_val[j] = v
+            heap_idx[j] = i
+    
+    order = np.argsort(-heap_val)
+    return heap_idx[order], heap_val[order]
+
+
+def _fuse_and_topk_numpy(sem: np.ndarray, bm: np.ndarray, w_sem: float, w_bm: float,
+                         m: int) -> Tuple[np.ndarray, np.ndarray]:
+    """NumPy fallback for fuse_and_topk when numba is not installed."""
+    if bm.max() > 0:
+        bm = bm / bm.max()
+    combined = w_sem * sem + w_bm * bm
+    # O(N) selection of the top m, then sort only those
+    m = min(m, combined.size)
+    top = np.argpartition(-combined, m - 1)[:m]
+    top = top[np.argsort(-combined[top])]
+    return top, combined[top]
+
+
+if njit is not None:
+    # cache=True stores the compiled kernel on disk so restarts skip the JIT compile
+    # Serial on purpose: sessions share one index and call this from their own
+    # threads, which numba's parallel workqueue layer aborts on
+    fuse_and_topk = njit(fastmath=True, cache=True)(_fuse_and_topk_kernel)
+else:
+    fuse_and_topk = _fuse_and_topk_numpy
 
 
 def extract_text(file, filename: str) -> str:
@@ -41,6 +220,15 @@ def extract_text(file, filename: str) -> str:
         
         if name.endswith(".pdf"):
             text = ""
+            if fitz is not None:
+                with fitz.open(stream=file.read(), filetype="pdf") as pdf:
+                    for page_num, page in enumerate(pdf, 1):
+                        extracted = page.get_text("text")
+                        if extracted.strip():
+                            # Add page marker for better tracking
+                            text += f"[PAGE {page_num}]\n{extracted}\n"
+                return text
+            
             with pdfplumber.open(file) as pdf:
                 for page_num, page in enumerate(pdf.pages, 1):
                     extracted = page.extract_text()
@@ -62,11 +250,8 @@ def extract_text(file, filename: str) -> str:
         return ""
 
 
-def is_definition_chunk(text: str, query: str) -> bool:
-    """Check if chunk contains a definition or explanation."""
-    text_lower = text.lower()
-    query_lower = query.lower()
-    
+def is_definition_chunk(text_lower: str, query_lower: str) -> bool:
+    """Check if a lowercased chunk contains a definition of the lowercased query."""
     # Definition patterns
     patterns = [
         f"{query_lower} is",
@@ -80,14 +265,25 @@ def is_definition_chunk(text: str, query: str) -> bool:
     return any(pattern in text_lower for pattern in patterns)
 
 
+def normalize_text(text: str) -> str:
+    """Collapse whitespace; chunk offsets refer to this form of the text."""
+    return re.sub(r"\s+", " ", text).strip()
+
+
 def chunk_text(text: str, chunk_size: int = CONFIG["CHUNK_SIZE"], 
-               overlap: int = CONFIG["OVERLAP"]) -> List[str]:
-    """Split text into chunks with metadata."""
+               overlap: int = CONFIG["OVERLAP"]) -> List[Tuple[str, int]]:
+    """Split text into (chunk, start offset in the normalized text) pairs."""
     if not text or not text.strip():
         return []
     
-    # Extract page markers and normalize whitespace
-    text_normalized = re.sub(r"\s+", " ", text).strip()
+    # Page markers are kept; whitespace is normalized
+    text_normalized = normalize_text(text)
+    
+    # Sentence-boundary offsets found in one vectorized pass
+    # (UTF-32 gives exactly one element per character; surrogatepass keeps lone
+    # surrogates from extracted text encodable)
+    codepoints = np.frombuffer(text_normalized.encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+    boundaries = np.flatnonzero((codepoints == ord(".")) | (codepoints == ord("!")) | (codepoints == ord("?")))
     
     chunks = []
     start = 0
@@ -97,14 +293,16 @@ def chunk_text(text: str, chunk_size: int = CONFIG["CHUNK_SIZE"],
         
         # Try to break at sentence boundary
         if end < len(text_normalized):
-            for pos in range(end, max(start + int(chunk_size * 0.7), end - 50), -1):
-                if text_normalized[pos] in '.!?':
-                    end = pos + 1
-                    break
+            # Last boundary in (lower, end]
+            lower = max(start + int(chunk_size * 0.7), end - 50)
+            idx = np.searchsorted(boundaries, end, side="right")
+            if idx > 0 and boundaries[idx - 1] > lower:
+                end = int(boundaries[idx - 1]) + 1
         
-        chunk = text_normalized[start:end].strip()
+        raw = text_normalized[start:end]
+        chunk = raw.strip()
         if chunk:
-            chunks.append(chunk)
+            chunks.append((chunk, start + len(raw) - len(raw.lstrip())))
         
         start = end - overlap if end < len(text_normalized) else end
     
@@ -112,41 +310,128 @@ def chunk_text(text: str, chunk_size: int = CONFIG["CHUNK_SIZE"],
     return chunks
 
 
-def build_index(chunks: List[str]) -> Dict[str, Any]:
-    """Build hybrid index with semantic embeddings and BM25."""
+def build_index(chunks: List[Tuple[str, int]], text: str = "") -> Dict[str, Any]:
+    """Build hybrid index with semantic embeddings, BM25 and a page table for text."""
     if not chunks:
         raise ValueError("No chunks to index")
     
     logger.info(f"Building index for {len(chunks)} chunks...")
     start_time = time.time()
     
+    offsets = np.array([offset for _, offset in chunks], dtype=np.int64)
+    chunks = [chunk for chunk, _ in chunks]
+    
+    # Page table: [PAGE n] marker positions in the normalized text
+    page_markers = [(m.start(), int(m.group(1)))
+                    for m in re.finditer(r'\[PAGE (\d+)\]', normalize_text(text))]
+    
     # Generate semantic embeddings
     logger.info("Generating embeddings...")
-    embeddings = model.encode(chunks, batch_size=32, show_progress_bar=True, convert_to_numpy=True)
+    # Normalized for cosine similarity as part of encoding
+    embeddings_normalized = encode(chunks, normalize_embeddings=True)
     
-    # Normalize for cosine similarity
-    embeddings_normalized = embeddings / (np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-10)
+    # Quantize to int8 (4x smaller, scored with int8 dot products)
+    embeddings_int8, embedding_scales = quantize_int8(embeddings_normalized)
+    assert embeddings_int8.ctypes.data % 64 == 0
     
     # Build BM25 index
     logger.info("Building BM25 index...")
-    tokenized_chunks = [chunk.split() for chunk in chunks]
-    bm25 = BM25Okapi(tokenized_chunks)
+    # Corpus is tokenized once into integer ids + a {token: id} vocab
+    # Stopwords are kept, as with the previous BM25Okapi index ("what is X" queries)
+    tokenized_chunks = bm25s.tokenize(chunks, stopwords=None, show_progress=False)
+    bm25 = None
+    if tokenized_chunks.vocab:  # bm25s cannot index a corpus with no tokens
+        bm25 = bm25s.BM25()
+        bm25.index(tokenized_chunks, show_progress=False)
+    
+    # Warm up the fusion kernel so the first query doesn't pay for JIT compilation
+    fuse_and_topk(np.zeros(1), np.zeros(1), CONFIG["SEMANTIC_WEIGHT"], CONFIG["BM25_WEIGHT"], 1)
     
     elapsed = time.time() - start_time
     logger.info(f"✓ Index built in {elapsed:.2f}s")
     
     return {
-        "embeddings": embeddings_normalized,
+        "embeddings": embeddings_int8,
+        "embedding_scales": embedding_scales,
         "bm25": bm25,
+        "vocab": tokenized_chunks.vocab,
         "chunks": chunks,
-        "time": elapsed
+        "chunks_lower": [chunk.lower() for chunk in chunks],
+        "offsets": offsets,
+        "page_starts": np.array([pos for pos, _ in page_markers], dtype=np.int64),
+        "page_numbers": [page for _, page in page_markers],
+        "time": elapsed,
+        "from_disk": False
     }
 
 
-def search(query: str, index: Dict[str, Any], k: int = CONFIG["K"]) -> List[Tuple[str, float]]:
+# Bump whenever the index dict layout changes so stale cache entries are ignored
+INDEX_FORMAT_VERSION = 1
+
+
+def _index_cache_paths(key: str, cache_dir: str) -> Tuple[str, str]:
+    return os.path.join(cache_dir, f"{key}.npy"), os.path.join(cache_dir, f"{key}.pkl")
+
+
+def save_index(index: Dict[str, Any], key: str, cache_dir: Optional[str] = None) -> None:
+    """Persist index: embeddings as a memory-mappable .npy, the rest pickled."""
+    # Read at call time so CONFIG["INDEX_CACHE_DIR"] = None disables caching at runtime
+    cache_dir = cache_dir or CONFIG["INDEX_CACHE_DIR"]
+    if not cache_dir:
+        return
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        npy_path, pkl_path = _index_cache_paths(key, cache_dir)
+        np.save(npy_path, index["embeddings"])
+        rest = {name: value for name, value in index.items() if name != "embeddings"}
+        # Pickle written last and renamed into place: its presence marks a complete entry
+        with open(pkl_path + ".tmp", "wb") as f:
+            pickle.dump(rest, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(pkl_path + ".tmp", pkl_path)
+        
+        # LRU eviction by last access time
+        entries = sorted(
+            (os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith(".pkl")),
+            key=os.path.getmtime, reverse=True
+        )
+        for stale in entries[CONFIG["INDEX_CACHE_SIZE"]:]:
+            for path in _index_cache_paths(os.path.basename(stale)[:-4], cache_dir):
+                if os.path.exists(path):
+                    os.remove(path)
+    except Exception as e:
+        logger.warning(f"Failed to cache index {key}: {e}")
+
+
+def load_index(key: str, cache_dir: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Load a cached index with memory-mapped embeddings, or None if absent."""
+    cache_dir = cache_dir or CONFIG["INDEX_CACHE_DIR"]
+    if not cache_dir:
+        return None
+    npy_path, pkl_path = _index_cache_paths(key, cache_dir)
+    if not (os.path.exists(npy_path) and os.path.exists(pkl_path)):
+        return None
+    start_time = time.time()
+    try:
+        with open(pkl_path, "rb") as f:
+            index = pickle.load(f)
+        # .npy data is 64-byte aligned, so the mmap keeps SIMD-friendly alignment
+        index["embeddings"] = np.load(npy_path, mmap_mode="r")
+        os.utime(pkl_path)
+    except Exception as e:
+        logger.warning(f"Failed to load cached index {key}: {e}")
+        return None
+    
+    fuse_and_topk(np.zeros(1), np.zeros(1), CONFIG["SEMANTIC_WEIGHT"], CONFIG["BM25_WEIGHT"], 1)
+    index["time"] = time.time() - start_time
+    index["from_disk"] = True
+    logger.info(f"✓ Loaded cached index {key} ({len(index['chunks'])} chunks)")
+    return index
+
+
+def search(query: str, index: Dict[str, Any], k: int = CONFIG["K"]) -> List[Tuple[str, float, int]]:
     """
     Hybrid search: 70% semantic + 30% BM25.
-    Returns chunks with highest combined score.
+    Returns (chunk, score, offset) for chunks with highest combined score.
     """
     if not query or not query.strip():
         raise ValueError("Query empty")
@@ -155,68 +440,52 @@ def search(query: str, index: Dict[str, Any], k: int = CONFIG["K"]) -> List[Tupl
     start = time.time()
     
     # SEMANTIC SEARCH
-    q_emb = model.encode([query])
-    q_norm = q_emb / (np.linalg.norm(q_emb, keepdims=True) + 1e-10)
-    semantic_scores = (index["embeddings"] @ q_norm.T).ravel()
+    q_norm = encode([query], normalize_embeddings=True)
+    q_int8, q_scale = quantize_int8(q_norm)
+    # int8 dot products; rescaling by both row scales recovers the cosine similarity
+    dots = np.asarray(simsimd.cdist(q_int8, index["embeddings"], metric="dot")).ravel()
+    semantic_scores = dots * (index["embedding_scales"] * q_scale[0])
     
     # BM25 SEARCH
-    query_tokens = query.lower().split()
-    bm25_scores = index["bm25"].get_scores(query_tokens)
-    
-    # Normalize BM25 scores to [0, 1]
-    if bm25_scores.max() > 0:
-        bm25_scores = bm25_scores / bm25_scores.max()
+    # Map query tokens straight to corpus ids; unknown tokens and stopwords drop out
+    vocab = index["vocab"]
+    query_ids = [vocab.get(token, -1) for token in TOKEN_PATTERN.findall(query.lower())]
+    query_ids = [token_id for token_id in query_ids if token_id >= 0]
+    if query_ids and index["bm25"] is not None:
+        bm25_scores = index["bm25"].get_scores(query_ids)
+    else:
+        bm25_scores = np.zeros(len(index["chunks"]))
     
-    # HYBRID SCORE: weighted combination
-    combined_scores = (
-        CONFIG["SEMANTIC_WEIGHT"] * semantic_scores + 
-        CONFIG["BM25_WEIGHT"] * bm25_scores
+    # HYBRID SCORE: weighted combination of semantic and [0, 1]-normalized BM25,
+    # top 3x candidates kept to filter
+    top_k_idx, top_scores = fuse_and_topk(
+        semantic_scores.astype(np.float64), bm25_scores.astype(np.float64),
+        CONFIG["SEMANTIC_WEIGHT"], CONFIG["BM25_WEIGHT"], k*3
     )
     
-    # Get top results
-    top_k_idx = np.argsort(combined_scores)[::-1][:k*3]  # Get 3x to filter
-    
     # Filter and rank: prioritize definition chunks
+    query_lower = query.lower()
     results = []
-    for idx in top_k_idx:
+    for idx, score in zip(top_k_idx, top_scores):
         chunk = index["chunks"][idx]
-        score = combined_scores[idx]
         
         # Boost score if it's a definition
-        if is_definition_chunk(chunk, query):
+        if is_definition_chunk(index["chunks_lower"][idx], query_lower):
             score = min(score * 1.3, 1.0)  # Boost but cap at 1.0
         
         if score > 0.1:  # Minimum threshold
-            results.append((chunk, float(score)))
+            results.append((chunk, float(score), int(index["offsets"][idx])))
     
     # Sort by score and take top k
     results = sorted(results, key=lambda x: x[1], reverse=True)[:k]
     
     logger.info(f"Found {len(results)} results in {time.time()-start:.3f}s")
-    logger.info(f"Scores: {[f'{s:.2f}' for _, s in results]}")
+    logger.info(f"Scores: {[f'{s:.2f}' for _, s, _ in results]}")
     
     return results
 
 
-def estimate_page(chunk_text: str, full_text: str) -> int:
-    """Estimate page number from chunk position."""
-    try:
-        # Extract page markers
-        page_matches = re.finditer(r'\[PAGE (\d+)\]', full_text)
-        pages = [(m.start(), int(m.group(1))) for m in page_matches]
-        
-        if not pages:
-            return 1
-        
-        pos = full_text.find(chunk_text)
-        if pos < 0:
-            return 1
-        
-        # Find which page this position falls in
-        for i in range(len(pages) - 1):
-            if pages[i][0] <= pos < pages[i+1][0]:
-                return pages[i][1]
-        
-        return pages[-1][1] if pages else 1
-    except:
-        return 1
+def estimate_page(offset: int, index: Dict[str, Any]) -> int:
+    """Page number for a chunk offset, looked up in the index's page table."""
+    i = np.searchsorted(index["page_starts"], offset, side="right") - 1
+    return index["page_numbers"][i] if i >= 0 else 1